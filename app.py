@@ -1,16 +1,39 @@
 import os
+import atexit
+import hashlib
+import queue
+import string
+import threading
+import time
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
+from torchvision.io import ImageReadMode, decode_jpeg
 
 from flask import Flask, request, redirect, jsonify
+from flask_compress import Compress
 from flask_cors import CORS
+from html import escape
 from urllib.parse import urlencode
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from ultralytics import YOLO
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+try:
+    from numba import njit
+except ImportError:  # optional; best_box falls back to NumPy
+    njit = None
+
+try:
+    import xxhash
+except ImportError:  # optional; upload_key falls back to blake2b
+    xxhash = None
+
 # ================== CONFIG ==================
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -20,8 +43,47 @@ PT_MODEL_PATH = os.getenv(
     os.path.join(BASE_DIR, "best.pt"),
 )
 
+# Folder of representative uploads. When set and serving ONNX on CPU, the
+# export is statically quantized to INT8 using up to 200 of these images.
+# The INT8 file is keyed by those images, so changing them recalibrates.
+INT8_CALIB_DIR = os.getenv("INT8_CALIB_DIR", "")
+
+# Uploads above this size are rejected with 413 before they are parsed
+MAX_UPLOAD_MB = float(os.getenv("MAX_UPLOAD_MB", "10"))
+
+# Detections of the most recent distinct uploads, keyed by content hash, so
+# retried uploads skip decode and inference (0 disables)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+
+# Served format: "onnx", "engine" (TensorRT, CUDA only) or "pt".
+# Exports are written once next to the .pt file and reused; the file name
+# records IMGSZ, BATCH_MAX and precision, so changing any of them re-exports.
+MODEL_FORMAT = os.getenv("MODEL_FORMAT", "onnx").lower()
+
 CONF_THRESHOLD = float(os.getenv("CONF_THRESHOLD", "0.35"))
 
+IMGSZ = int(os.getenv("IMGSZ", "640"))
+
+# Only the single best component is reported, so keep NMS output small
+MAX_DET = int(os.getenv("MAX_DET", "16"))
+
+# Largest YOLO feature stride; letterbox canvases are padded to a multiple of it
+STRIDE = 32
+
+# Inference device; FP16 is only used on CUDA
+DEVICE = os.getenv("INFER_DEVICE", "cuda:0" if torch.cuda.is_available() else "cpu")
+HALF = DEVICE.startswith("cuda")
+
+# Decode JPEG uploads on the GPU (nvJPEG) when inferring on CUDA
+GPU_DECODE = HALF and os.getenv("GPU_DECODE", "1") == "1"
+
+# Micro-batching: concurrent requests are grouped into one predict call
+BATCH_MAX = int(os.getenv("BATCH_MAX", "16"))
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "10"))
+
+# CPU threads used by torch for inference
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", str(os.cpu_count() or 1)))
+
 FIREBASE_KEY_PATH = os.getenv(
     "FIREBASE_KEY_PATH",
     r"serviceAccountKey.json",
@@ -58,22 +120,329 @@ CLASS_NAMES = [
     "qr_code",
 ]
 
+# ================== TORCH RUNTIME ==================
+
+# Inference only. Grad mode is per thread, so the batch worker also runs
+# under inference_mode.
+torch.set_grad_enabled(False)
+torch.set_num_interop_threads(1)
+if DEVICE == "cpu":
+    torch.set_num_threads(TORCH_THREADS)
+
 # ================== APP ==================
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
+Compress(app)
+app.config["MAX_CONTENT_LENGTH"] = int(MAX_UPLOAD_MB * 1024 * 1024)
 
 if not os.path.exists(PT_MODEL_PATH):
     raise FileNotFoundError(f"PT model not found at: {PT_MODEL_PATH}")
 
-model = YOLO(PT_MODEL_PATH)
+def _is_stale(path, source):
+    return not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source)
+
+def calib_images():
+    """
+    Up to 200 calibration images from INT8_CALIB_DIR, in a stable order.
+    """
+    return sorted(
+        os.path.join(INT8_CALIB_DIR, f)
+        for f in os.listdir(INT8_CALIB_DIR)
+        if f.lower().endswith((".jpg", ".jpeg", ".png"))
+    )[:200]
+
+def calib_key(paths):
+    """
+    Short hash of the calibration images' names, sizes and mtimes.
+    """
+    h = hashlib.blake2b(digest_size=4)
+    for path in paths:
+        st = os.stat(path)
+        h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()
+
+def quantize_onnx(onnx_path, int8_path, paths):
+    """
+    Static INT8 quantization (QDQ, per-channel weights, MinMax activations) of
+    the Conv layers, calibrated on the given images. The detection head's box
+    decoding stays in float.
+    """
+    import onnx
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+    from ultralytics.data.augment import LetterBox
+
+    src = onnx.load(onnx_path)
+    input_name = src.graph.input[0].name
+    letterbox = LetterBox((IMGSZ, IMGSZ), auto=False)
+    if not paths:
+        raise FileNotFoundError(f"no calibration images in {INT8_CALIB_DIR}")
+
+    class CalibReader(CalibrationDataReader):
+        def __init__(self):
+            self.paths = iter(paths)
+
+        def get_next(self):
+            for path in self.paths:
+                img = cv2.imread(path)
+                if img is None:
+                    continue
+                x = letterbox(image=img)[..., ::-1].transpose(2, 0, 1)[None]
+                return {input_name: np.ascontiguousarray(x, dtype=np.float32) / 255}
+            return None
+
+    # Written aside and moved into place, so an interrupted run never leaves a
+    # partial model that looks fresher than the export
+    tmp_path = int8_path.replace(".onnx", ".tmp.onnx")
+    quantize_static(
+        onnx_path,
+        tmp_path,
+        CalibReader(),
+        quant_format=QuantFormat.QDQ,
+        op_types_to_quantize=["Conv"],
+        per_channel=True,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        calibrate_method=CalibrationMethod.MinMax,
+    )
+
+    # Ultralytics reads names/stride/imgsz from the model metadata
+    dst = onnx.load(tmp_path)
+    del dst.metadata_props[:]
+    dst.metadata_props.extend(src.metadata_props)
+    onnx.save(dst, tmp_path)
+    os.replace(tmp_path, int8_path)
+    print(f"[Model] INT8 model calibrated on {len(paths)} images")
+
+def load_model():
+    """
+    Returns (model, path) for the served model, exporting best.pt first if needed.
+    Exports take a dynamic batch dimension (up to BATCH_MAX) for the batch worker.
+    Falls back to the FP32 export if INT8 quantization fails, and to the
+    PyTorch weights if the export itself fails.
+    """
+    fmt = MODEL_FORMAT
+    if fmt == "engine" and not HALF:
+        fmt = "onnx"
+
+    if fmt != "pt":
+        precision = "fp16" if HALF else "fp32"
+        export_path = f"{os.path.splitext(PT_MODEL_PATH)[0]}_{IMGSZ}_b{BATCH_MAX}_{precision}.{fmt}"
+        try:
+            if _is_stale(export_path, PT_MODEL_PATH):
+                exported = YOLO(PT_MODEL_PATH).export(
+                    format=fmt,
+                    imgsz=IMGSZ,
+                    half=HALF,
+                    dynamic=True,
+                    batch=BATCH_MAX,
+                    simplify=True,
+                    device=DEVICE,
+                )
+                os.replace(exported, export_path)
+
+            if fmt == "onnx" and INT8_CALIB_DIR and not HALF:
+                try:
+                    paths = calib_images()
+                    int8_path = export_path.replace(".onnx", f".int8-{calib_key(paths)}.onnx")
+                    if _is_stale(int8_path, export_path):
+                        quantize_onnx(export_path, int8_path, paths)
+                    export_path = int8_path
+                except Exception as e:
+                    print(f"[Model] INT8 quantization failed, serving {export_path}:", e)
+
+            return YOLO(export_path, task="detect"), export_path
+        except Exception as e:
+            print(f"[Model] {fmt} export failed, serving {PT_MODEL_PATH}:", e)
+
+    pt_model = YOLO(PT_MODEL_PATH)
+    pt_model.fuse(verbose=False)
+    return pt_model, PT_MODEL_PATH
+
+model, MODEL_PATH = load_model()
+
+# predict() kwargs, built once so every request reuses the same predictor setup
+PREDICT_ARGS = {
+    "conf": CONF_THRESHOLD,
+    "iou": 0.5,
+    "max_det": MAX_DET,
+    "agnostic_nms": True,
+    "imgsz": IMGSZ,
+    "device": DEVICE,
+    "verbose": False,
+}
+if HALF:
+    PREDICT_ARGS["half"] = True
+
+# Reused letterbox buffers: host canvas (pinned on CUDA) and the model input batch
+_SCRATCH_T = torch.empty((BATCH_MAX, IMGSZ, IMGSZ, 3), dtype=torch.uint8, pin_memory=HALF)
+_SCRATCH = _SCRATCH_T.numpy()
+_INPUT = torch.empty(
+    (BATCH_MAX, 3, IMGSZ, IMGSZ),
+    dtype=torch.float16 if HALF else torch.float32,
+    device=DEVICE,
+)
+
+# Set once the batch worker has finished warming the model
+_warmed = threading.Event()
+_warm_error = None
+
+def warm_model():
+    """
+    Runs dummy predicts at batch 1 and BATCH_MAX so the predictor (backend
+    session, device placement, FP16 cast, largest activations) is built
+    before the first request. Called from the batch worker, which owns the
+    model from then on.
+    """
+    model.predict(source=_INPUT[:1].zero_(), **PREDICT_ARGS)
+    model.predict(source=_INPUT.zero_(), **PREDICT_ARGS)
+    print(f"[Model] {os.path.basename(MODEL_PATH)} ready on {DEVICE} (half={HALF})")
+
+# ================== BATCHING ==================
+
+# (image, Future) pairs waiting for the batch worker; None stops it
+_pending = queue.Queue()
+
+@torch.inference_mode()
+def _batch_worker():
+    """
+    Collects up to BATCH_MAX images, waiting at most BATCH_WINDOW_MS after the
+    first one, and runs one predict call per letterbox canvas among them.
+    Only this thread touches the buffers and the model, so predictor state
+    is never shared between request threads and at most one batch is in
+    flight. It also builds the predictor, during warm-up.
+    """
+    global _warm_error
+    try:
+        warm_model()
+    except Exception as e:
+        _warm_error = e
+    _warmed.set()
+    if _warm_error is not None:
+        return
+
+    window = BATCH_WINDOW_MS / 1000.0
+    while True:
+        item = _pending.get()
+        if item is None:
+            return
+        batch = [item]
+        deadline = time.monotonic() + window
+        while len(batch) < BATCH_MAX:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = _pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                _pending.put(None)
+                break
+            batch.append(item)
+
+        # One predict per canvas, so an image gets the same stride-aligned input
+        # whatever else is in flight
+        groups = {}
+        for item in batch:
+            groups.setdefault(letterbox_canvas(*image_hw(item[0])), []).append(item)
+        for (ch, cw), items in groups.items():
+            _predict_group(items, ch, cw)
+
+def _predict_group(items, ch, cw):
+    """
+    Letterboxes same-canvas (image, Future) pairs into the reused buffers,
+    runs one predict call and resolves the Futures.
+    """
+    n = len(items)
+    scratch = _SCRATCH.reshape(-1)[:n * ch * cw * 3].reshape(n, ch, cw, 3)
+    scratch_t = torch.from_numpy(scratch)
+    inputs = _INPUT.view(-1)[:n * 3 * ch * cw].view(n, 3, ch, cw)
+
+    futs = []
+    for img, fut in items:
+        i = len(futs)
+        try:
+            if isinstance(img, np.ndarray):
+                letterbox_into(img, scratch[i])
+                bgr_to_rgb_chw(scratch_t[i], inputs[i])
+                inputs[i].div_(255)
+            else:
+                letterbox_gpu(img, inputs[i])
+        except Exception as e:
+            fut.set_exception(e)
+            continue
+        futs.append(fut)
+
+    if not futs:
+        return
+
+    try:
+        results = model.predict(source=inputs[:len(futs)], **PREDICT_ARGS)
+    except Exception as e:
+        for fut in futs:
+            fut.set_exception(e)
+        return
+
+    for fut, r in zip(futs, results):
+        fut.set_result(r)
+
+_batch_thread = threading.Thread(target=_batch_worker, name="yolo-batch", daemon=True)
+_batch_thread.start()
+
+def _stop_batch_worker():
+    """
+    Lets the worker finish its current batch and return at exit, so it is not
+    torn down mid-call by interpreter shutdown.
+    """
+    _pending.put(None)
+    _batch_thread.join()
+
+atexit.register(_stop_batch_worker)
+
+# Block import until warm-up is done; a model that cannot run should fail startup
+_warmed.wait()
+if _warm_error is not None:
+    raise _warm_error
+
+def predict_batched(image):
+    """
+    Queues one image for the batch worker and blocks until its result is ready.
+    """
+    fut = Future()
+    _pending.put((image, fut))
+    return fut.result()
 
 # ================== FIREBASE INIT (Firestore) ==================
 
 db_fs = None
+fs_collection = None
+
+# Firestore writes run here so requests don't wait on the RPC
+# (concurrent.futures shuts it down at exit, waiting for in-flight commits)
+_FS_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="firestore")
+
+# Results are buffered and committed as one WriteBatch per FS_BATCH_SIZE docs
+# or FS_FLUSH_MS, whichever comes first
+FS_BATCH_SIZE = int(os.getenv("FS_BATCH_SIZE", "20"))
+FS_FLUSH_MS = float(os.getenv("FS_FLUSH_MS", "200"))
+
+_fs_pending = []  # (ref, doc) waiting for the next commit
+_fs_lock = threading.Lock()
+_fs_timer = None
+_fs_flush_lock = threading.Lock()  # held from taking the buffer until its commit is handed off
+
+# Per-document constants
+_FS_MODEL_NAME = os.path.basename(MODEL_PATH)
 
 def init_firestore():
-    global db_fs
+    global db_fs, fs_collection
     try:
         if not FIREBASE_KEY_PATH or not os.path.exists(FIREBASE_KEY_PATH):
             print("[Firebase] Firestore skipped: key not found:", FIREBASE_KEY_PATH)
@@ -84,27 +453,89 @@ def init_firestore():
             firebase_admin.initialize_app(cred)
 
         db_fs = firestore.client()
+        fs_collection = db_fs.collection(FIRESTORE_COLLECTION)
         print("[Firebase] Firestore initialized OK")
     except Exception as e:
         print("[Firebase] Firestore init error:", e)
 
+def _log_write_error(fut):
+    if fut.exception() is not None:
+        print("[Firebase] Firestore write error:", fut.exception())
+
+def _commit_batch(writes):
+    batch = db_fs.batch()
+    for ref, doc in writes:
+        batch.set(ref, doc)
+    batch.commit()
+
+def _take_pending():
+    global _fs_pending, _fs_timer
+    with _fs_lock:
+        writes, _fs_pending = _fs_pending, []
+        if _fs_timer is not None:
+            _fs_timer.cancel()
+            _fs_timer = None
+    return writes
+
+def flush_firestore(inline=False):
+    """
+    Commits all buffered writes as one WriteBatch on the Firestore pool, or on
+    the calling thread when inline or once the pool has shut down at exit.
+    """
+    with _fs_flush_lock:
+        writes = _take_pending()
+        if not writes:
+            return
+        if not inline:
+            try:
+                _FS_POOL.submit(_commit_batch, writes).add_done_callback(_log_write_error)
+                return
+            except RuntimeError:  # pool already shut down; a late flush timer
+                pass
+        try:
+            _commit_batch(writes)
+        except Exception as e:
+            print("[Firebase] Firestore write error:", e)
+
+# The pool is shut down before atexit handlers run, so the final flush commits
+# inline; the flush lock makes it wait for a timer flush still committing
+atexit.register(flush_firestore, inline=True)
+
 def save_result_to_firestore(result_json: dict, material_id: str = "", source: str = ""):
     """
     Stores the EXACT result JSON + some metadata.
+    The write is buffered and committed in the background; the new doc id is
+    returned immediately.
     """
+    global _fs_timer
     if db_fs is None:
         return None
 
-    doc = dict(result_json)  # copy exact JSON
-    doc["materialId"] = material_id or None
-    doc["source"] = source or None
-    doc["threshold"] = CONF_THRESHOLD
-    doc["model"] = os.path.basename(PT_MODEL_PATH)
-    doc["createdAt"] = firestore.SERVER_TIMESTAMP
+    ref = fs_collection.document()
 
-    ref = db_fs.collection(FIRESTORE_COLLECTION).document()
-    doc["id"] = ref.id
-    ref.set(doc)
+    # Built in one literal: exact JSON + metadata. A separate dict is required
+    # because the caller adds docId to result_json while this one is still
+    # waiting in the write buffer.
+    doc = {
+        **result_json,
+        "materialId": material_id or None,
+        "source": source or None,
+        "threshold": CONF_THRESHOLD,
+        "model": _FS_MODEL_NAME,
+        "createdAt": firestore.SERVER_TIMESTAMP,
+        "id": ref.id,
+    }
+
+    with _fs_lock:
+        _fs_pending.append((ref, doc))
+        full = len(_fs_pending) >= FS_BATCH_SIZE
+        if not full and _fs_timer is None:
+            _fs_timer = threading.Timer(FS_FLUSH_MS / 1000.0, flush_firestore)
+            _fs_timer.daemon = True
+            _fs_timer.start()
+
+    if full:
+        flush_firestore()
     return ref.id
 
 init_firestore()
@@ -118,51 +549,307 @@ def parse_component(class_name: str):
             return comp
     return None
 
-def run_pt_inference(image_bgr):
-    image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+def build_class_tables():
+    """
+    Resolves every class id once: the served model's names win, CLASS_NAMES
+    fills the gaps. Returns (id -> class name, id -> component or None).
+    """
+    names = model.names if isinstance(model.names, dict) else {}
+    n = max(len(CLASS_NAMES), max(names, default=-1) + 1)
 
-    results = model.predict(
-        source=image_rgb,
-        conf=CONF_THRESHOLD,
-        imgsz=640,
-        device="cpu",
-        verbose=False,
-    )
+    id_to_name = []
+    for cls_id in range(n):
+        if cls_id in names:
+            id_to_name.append(names[cls_id])
+        elif cls_id < len(CLASS_NAMES):
+            id_to_name.append(CLASS_NAMES[cls_id])
+        else:
+            id_to_name.append(str(cls_id))
+
+    return id_to_name, [parse_component(name) for name in id_to_name]
+
+CLS_ID_TO_NAME, CLS_ID_TO_COMP = build_class_tables()
+
+# Mask of class ids that map to a component, for vectorized filtering
+CLS_HAS_COMP = np.array([comp is not None for comp in CLS_ID_TO_COMP])
+
+# Classes without a component (qr_code) can never be reported; drop them in NMS
+PREDICT_ARGS["classes"] = np.flatnonzero(CLS_HAS_COMP).tolist()
 
-    r = results[0]
+def _best_box_numpy(confs, clses, has_comp):
+    """
+    Index of the highest-confidence box whose class has a component, or -1.
+    """
+    known = clses < len(has_comp)
+    valid = known & has_comp[np.where(known, clses, 0)]
+    if not valid.any():
+        return -1
+    return int(np.argmax(np.where(valid, confs, -1.0)))
+
+def _best_box_loop(confs, clses, has_comp):
+    best_i, best_conf = -1, -1.0
+    for i in range(confs.shape[0]):
+        c = clses[i]
+        if c < has_comp.shape[0] and has_comp[c] and confs[i] > best_conf:
+            best_conf = confs[i]
+            best_i = i
+    return best_i
+
+if njit is not None:
+    best_box = njit(cache=True, boundscheck=False)(_best_box_loop)
+    best_box(np.zeros(1, np.float32), np.zeros(1, np.intp), CLS_HAS_COMP)  # compile now
+else:
+    best_box = _best_box_numpy
+
+def _jpeg_segments(buf):
+    """
+    Yields (marker, offset) for each JPEG header segment before the scan data.
+    """
+    i = 2
+    while i + 4 <= len(buf) and buf[i] == 0xFF:
+        marker = buf[i + 1]
+        if marker == 0xDA:  # start of scan: no more header segments
+            return
+        yield marker, i
+        i += 2 + int.from_bytes(buf[i + 2:i + 4], "big")
+
+def jpeg_exif_orientation(buf):
+    """
+    Returns the EXIF orientation tag of a JPEG (1 when absent).
+    """
+    for marker, i in _jpeg_segments(buf):
+        if marker == 0xE1 and buf[i + 4:i + 10] == b"Exif\0\0":
+            tiff = i + 10
+            order = "little" if buf[tiff:tiff + 2] == b"II" else "big"
+            ifd = tiff + int.from_bytes(buf[tiff + 4:tiff + 8], order)
+            for k in range(int.from_bytes(buf[ifd:ifd + 2], order)):
+                entry = ifd + 2 + 12 * k
+                if int.from_bytes(buf[entry:entry + 2], order) == 0x0112:
+                    return int.from_bytes(buf[entry + 8:entry + 10], order)
+            break
+    return 1
+
+# Start-of-frame markers; their segment carries the image height and width
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def jpeg_size(buf):
+    """
+    Returns (H, W) from a JPEG's start-of-frame segment, or None.
+    """
+    for marker, i in _jpeg_segments(buf):
+        if marker in _SOF_MARKERS:
+            return int.from_bytes(buf[i + 5:i + 7], "big"), int.from_bytes(buf[i + 7:i + 9], "big")
+    return None
+
+# libjpeg can decode at 1/8, 1/4 or 1/2 scale; OR'd onto the colour flag
+_IMREAD_REDUCED = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+def jpeg_reduce_flag(buf):
+    """
+    Largest reduced-decode flag that still leaves the long side >= IMGSZ
+    (letterboxing would shrink it to IMGSZ anyway); 0 for a full decode.
+    """
+    size = jpeg_size(buf)
+    if size is None:
+        return 0
+
+    for factor, flag in _IMREAD_REDUCED:
+        if max(size) // factor >= IMGSZ:
+            return flag
+    return 0
+
+# EXIF orientation -> quarter turns for torch.rot90 (mirrored variants go to OpenCV)
+_EXIF_ROT90 = {1: 0, 3: 2, 6: -1, 8: 1}
+
+def image_hw(img):
+    """
+    (H, W) of an (H, W, 3) ndarray or a (3, H, W) tensor.
+    """
+    return img.shape[:2] if isinstance(img, np.ndarray) else tuple(img.shape[1:])
+
+def letterbox_size(h, w):
+    """
+    (nh, nw) of an h x w image scaled to fit inside IMGSZ x IMGSZ.
+    """
+    r = min(IMGSZ / h, IMGSZ / w)
+    return max(1, round(h * r)), max(1, round(w * r))
+
+def letterbox_canvas(h, w):
+    """
+    Smallest stride-aligned canvas holding the scaled image (Ultralytics' rect mode).
+    """
+    nh, nw = letterbox_size(h, w)
+    return -(-nh // STRIDE) * STRIDE, -(-nw // STRIDE) * STRIDE
+
+def letterbox_into(img, dst):
+    """
+    Letterboxes an (H, W, 3) uint8 ndarray into the centre of the (h, w, 3) buffer dst.
+    """
+    nh, nw = letterbox_size(*img.shape[:2])
+    top, left = (dst.shape[0] - nh) // 2, (dst.shape[1] - nw) // 2
+
+    dst[:top] = 114
+    dst[top + nh:] = 114
+    dst[top:top + nh, :left] = 114
+    dst[top:top + nh, left + nw:] = 114
+    cv2.resize(img, (nw, nh), dst=dst[top:top + nh, left:left + nw], interpolation=cv2.INTER_LINEAR)
+
+def bgr_to_rgb_chw(src, dst):
+    """
+    Copies an (h, w, 3) BGR uint8 canvas into a (3, h, w) RGB input slot.
+    The channel swap rides on the layout copy, so no separate cvtColor pass.
+    """
+    for c in range(3):
+        dst[c].copy_(src[..., 2 - c], non_blocking=True)
+
+def _letterbox_normalize(img, nh: int, nw: int, pad_t: int, pad_b: int, pad_l: int, pad_r: int):
+    x = F.interpolate(img[None].float(), size=(nh, nw), mode="bilinear", align_corners=False)
+    x = F.pad(x, (pad_l, pad_r, pad_t, pad_b), value=114.0)
+    return x[0].div(255).to(_INPUT.dtype)
+
+# On CUDA, resize + pad + /255 + cast compile into one fused kernel
+_letterbox_fn = torch.compile(_letterbox_normalize, dynamic=True) if GPU_DECODE else _letterbox_normalize
+
+def letterbox_gpu(img, dst):
+    """
+    Letterboxes a (3, H, W) uint8 device tensor into the centre of the (3, h, w)
+    slot dst, normalized to [0, 1] in the slot's dtype.
+    """
+    global _letterbox_fn
+    nh, nw = letterbox_size(*img.shape[1:])
+    top, left = (dst.shape[1] - nh) // 2, (dst.shape[2] - nw) // 2
+    pads = (top, dst.shape[1] - nh - top, left, dst.shape[2] - nw - left)
+
+    try:
+        dst.copy_(_letterbox_fn(img, nh, nw, *pads))
+    except Exception as e:
+        if _letterbox_fn is _letterbox_normalize:
+            raise
+        print("[Decode] compiled letterbox failed, using eager:", e)
+        _letterbox_fn = _letterbox_normalize
+        dst.copy_(_letterbox_fn(img, nh, nw, *pads))
+
+if GPU_DECODE:
+    # Compile now for landscape and portrait inputs rather than on the first upload
+    with torch.inference_mode():
+        for h, w in ((IMGSZ * 3 // 4, IMGSZ), (IMGSZ, IMGSZ * 3 // 4)):
+            letterbox_gpu(torch.zeros((3, h, w), dtype=torch.uint8, device=DEVICE), torch.empty_like(_INPUT[0]))
+
+def read_upload(file):
+    """
+    Reads an uploaded file into one bytearray sized from its spooled stream,
+    skipping the intermediate bytes object file.read() builds.
+    """
+    stream = file.stream
+    stream.seek(0, os.SEEK_END)
+    buf = bytearray(stream.tell())
+    stream.seek(0)
+
+    view = memoryview(buf)
+    n = 0
+    while n < len(buf):
+        got = stream.readinto(view[n:])
+        if not got:
+            break
+        n += got
+    view.release()
+
+    del buf[n:]
+    return buf
+
+def decode_image(file_bytes):
+    """
+    Decodes an upload. With GPU_DECODE, JPEGs are decoded by nvJPEG into an RGB
+    (3, H, W) device tensor; anything else goes through OpenCV as a BGR ndarray,
+    with large JPEGs decoded at a reduced scale.
+    Returns None if the bytes cannot be decoded.
+    """
+    if not file_bytes:
+        return None
+
+    if GPU_DECODE and file_bytes[:2] == b"\xff\xd8":
+        turns = _EXIF_ROT90.get(jpeg_exif_orientation(file_bytes))
+        if turns is not None:
+            try:
+                data = torch.frombuffer(file_bytes, dtype=torch.uint8)
+                img = decode_jpeg(data, mode=ImageReadMode.RGB, device=DEVICE)
+                return torch.rot90(img, turns, dims=(1, 2))
+            except RuntimeError as e:
+                print("[Decode] nvJPEG failed, using OpenCV:", e)
+
+    reduce = jpeg_reduce_flag(file_bytes) if file_bytes[:2] == b"\xff\xd8" else 0
+
+    file_array = np.frombuffer(file_bytes, np.uint8)
+    return cv2.imdecode(file_array, cv2.IMREAD_COLOR | reduce)
+
+def run_pt_inference(image):
+    """
+    Runs detection on an image returned by decode_image.
+    """
+    r = predict_batched(image)
     if r.boxes is None or len(r.boxes) == 0:
         return None
 
-    best = None
-    best_conf = -1.0
+    confs = r.boxes.conf.cpu().numpy()
+    clses = r.boxes.cls.cpu().numpy().astype(np.intp)
 
-    for b in r.boxes:
-        conf = float(b.conf.item()) if hasattr(b.conf, "item") else float(b.conf)
-        cls_id = int(b.cls.item()) if hasattr(b.cls, "item") else int(b.cls)
+    i = best_box(confs, clses, CLS_HAS_COMP)
+    if i < 0:
+        return None
 
-        if hasattr(r, "names") and isinstance(r.names, dict) and cls_id in r.names:
-            class_name = r.names[cls_id]
-        elif cls_id < len(CLASS_NAMES):
-            class_name = CLASS_NAMES[cls_id]
-        else:
-            class_name = str(cls_id)
+    cls_id = int(clses[i])
+    return {
+        "component": CLS_ID_TO_COMP[cls_id],
+        "confidence": float(confs[i]),
+        "class_name": CLS_ID_TO_NAME[cls_id],
+    }
 
-        comp = parse_component(class_name)
-        if comp is None:
-            continue
+_result_cache = OrderedDict()  # upload key -> detection (None = not detected)
+_result_lock = threading.Lock()
 
-        if conf > best_conf:
-            best_conf = conf
-            best = {
-                "component": comp,
-                "confidence": conf,
-                "class_name": class_name,
-            }
+def upload_key(file_bytes):
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(file_bytes)
+    return hashlib.blake2b(file_bytes, digest_size=8).digest()
 
-    return best
+def detect_upload(file_bytes):
+    """
+    Decodes an upload and runs detection, memoized by content hash so a
+    retried upload returns without decode or inference. Safe to memoize
+    because the batch worker gives each image its own canvas, so the
+    detection never depends on concurrent traffic.
+    Returns (decoded, detection).
+    """
+    key = upload_key(file_bytes)
+    with _result_lock:
+        if key in _result_cache:
+            _result_cache.move_to_end(key)
+            return True, _result_cache[key]
+
+    image = decode_image(file_bytes)
+    if image is None:
+        return False, None
+
+    det = run_pt_inference(image)
+    if RESULT_CACHE_SIZE > 0:
+        with _result_lock:
+            _result_cache[key] = det
+            if len(_result_cache) > RESULT_CACHE_SIZE:
+                _result_cache.popitem(last=False)
+    return True, det
 
 # ================== ROUTES ==================
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    if request.path == "/api/verify_web":
+        return "Image too large", 413
+    return jsonify({"ok": False, "error": "image too large"}), 413
+
 @app.route("/")
 def home():
     return redirect("/verify")
@@ -172,17 +859,15 @@ def health():
     return jsonify({
         "ok": True,
         "ptModelPath": PT_MODEL_PATH,
+        "modelPath": MODEL_PATH,
         "threshold": CONF_THRESHOLD,
+        "device": DEVICE,
         "firestore": bool(db_fs),
         "collection": FIRESTORE_COLLECTION,
     })
 
-@app.route("/verify", methods=["GET"])
-def verify_page():
-    callback = request.args.get("callback", "")
-    mid = request.args.get("materialId", "")
-
-    return f"""
+# /verify page; only the two query params are substituted per request
+_VERIFY_PAGE = string.Template("""
 <!doctype html>
 <html>
 <head>
@@ -190,21 +875,21 @@ def verify_page():
   <meta name="viewport" content="width=device-width, initial-scale=1"/>
   <title>AI Verify (PT)</title>
   <style>
-    body{{font-family:system-ui;background:#f7e8ff;margin:0;display:flex;min-height:100vh;align-items:center;justify-content:center}}
-    .card{{background:#fff;padding:18px;border-radius:18px;max-width:420px;width:92%;box-shadow:0 10px 30px rgba(0,0,0,.08)}}
-    button{{padding:10px 14px;border:0;border-radius:999px;background:#A259FF;color:#fff;font-weight:700;cursor:pointer;width:100%}}
-    input{{width:100%;margin:10px 0}}
-    .muted{{color:#666;font-size:12px}}
+    body{font-family:system-ui;background:#f7e8ff;margin:0;display:flex;min-height:100vh;align-items:center;justify-content:center}
+    .card{background:#fff;padding:18px;border-radius:18px;max-width:420px;width:92%;box-shadow:0 10px 30px rgba(0,0,0,.08)}
+    button{padding:10px 14px;border:0;border-radius:999px;background:#A259FF;color:#fff;font-weight:700;cursor:pointer;width:100%}
+    input{width:100%;margin:10px 0}
+    .muted{color:#666;font-size:12px}
   </style>
 </head>
 <body>
   <div class="card">
     <h3 style="margin:0;color:#4B3A7A">Track Fitting AI Verification (best.pt)</h3>
-    <p class="muted">Material: <b>{mid or "-"}</b></p>
+    <p class="muted">Material: <b>$mid_label</b></p>
 
     <form method="POST" action="/api/verify_web" enctype="multipart/form-data">
-      <input type="hidden" name="callback" value="{callback}"/>
-      <input type="hidden" name="materialId" value="{mid}"/>
+      <input type="hidden" name="callback" value="$callback"/>
+      <input type="hidden" name="materialId" value="$mid"/>
       <input type="file" name="image" accept="image/*" capture="environment" required/>
       <button type="submit">Run AI Verification</button>
     </form>
@@ -213,7 +898,20 @@ def verify_page():
   </div>
 </body>
 </html>
-"""
+""")
+
+@app.route("/verify", methods=["GET"])
+def verify_page():
+    callback = request.args.get("callback", "")
+    mid = request.args.get("materialId", "")
+
+    page = _VERIFY_PAGE.substitute(
+        mid_label=escape(mid or "-"),
+        mid=escape(mid),
+        callback=escape(callback),
+    )
+    # The page depends only on the query string, so it can be cached per URL
+    return page, 200, {"Cache-Control": "public, max-age=3600"}
 
 @app.route("/api/verify_web", methods=["POST"])
 def verify_web():
@@ -224,15 +922,12 @@ def verify_web():
     if not file:
         return "No image", 400
 
-    file_bytes = file.read()
-    file_array = np.frombuffer(file_bytes, np.uint8)
-    img_bgr = cv2.imdecode(file_array, cv2.IMREAD_COLOR)
+    file_bytes = read_upload(file)
+    decoded, det = detect_upload(file_bytes)
 
-    if img_bgr is None:
+    if not decoded:
         return "Failed to decode image", 400
 
-    det = run_pt_inference(img_bgr)
-
     if det is None:
         result_json = {
             "ok": True,
@@ -277,15 +972,12 @@ def api_verify():
 
     material_id = request.form.get("materialId", "")
 
-    file_bytes = file.read()
-    file_array = np.frombuffer(file_bytes, np.uint8)
-    img_bgr = cv2.imdecode(file_array, cv2.IMREAD_COLOR)
+    file_bytes = read_upload(file)
+    decoded, det = detect_upload(file_bytes)
 
-    if img_bgr is None:
+    if not decoded:
         return jsonify({"ok": False, "error": "failed to decode image"}), 400
 
-    det = run_pt_inference(img_bgr)
-
     if det is None:
         result_json = {
             "ok": True,
@@ -306,6 +998,3 @@ def api_verify():
 
     result_json["docId"] = doc_id
     return jsonify(result_json)
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
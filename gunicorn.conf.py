@@ -0,0 +1,22 @@
+# Production server: gunicorn -c gunicorn.conf.py
+import os
+
+wsgi_app = "app:app"
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# One process keeps a single resident model and lets the batch queue see every
+# request; threads give I/O concurrency around it.
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+# The batch worker and Firestore pool are threads started at import time, so the
+# app must be imported in the worker, not in the forking master.
+preload_app = False
+
+# The worker heartbeats only once the app has imported, and import blocks on the
+# ONNX/TensorRT export, INT8 calibration and model warm-up. A worker silent for
+# longer than this is killed and the export restarts, so it must cover a cold
+# start. Build the export ahead of deploys (python -c "import app") to keep
+# boots short.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "1800"))
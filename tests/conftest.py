@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def run_app():
+    """
+    Runs a script that imports app in a fresh interpreter, serving best.pt
+    with Firestore unconfigured, and returns its stdout lines.
+    Extra keyword arguments are set as environment variables.
+    """
+    def run(script, **env):
+        proc = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=ROOT,
+            env=dict(os.environ, FIREBASE_KEY_PATH="", MODEL_FORMAT="pt", **env),
+            capture_output=True,
+            text=True,
+            timeout=600,
+        )
+        assert proc.returncode == 0, proc.stderr
+        assert "Traceback" not in proc.stderr, proc.stderr
+        return proc.stdout.splitlines()
+
+    return run
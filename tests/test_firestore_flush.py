@@ -0,0 +1,62 @@
+# Fake Firestore client that prints every doc id it commits, after
+# COMMIT_DELAY seconds
+FAKE_FIRESTORE = """
+import time
+
+import app
+
+COMMIT_DELAY = 0
+
+class Ref:
+    n = 0
+    def __init__(self):
+        Ref.n += 1
+        self.id = f"doc{Ref.n}"
+
+class Batch:
+    def __init__(self):
+        self.ids = []
+    def set(self, ref, doc):
+        self.ids.append(ref.id)
+    def commit(self):
+        time.sleep(COMMIT_DELAY)
+        print("COMMIT", ",".join(self.ids), flush=True)
+
+class Collection:
+    def document(self):
+        return Ref()
+
+class Client:
+    def batch(self):
+        return Batch()
+
+app.db_fs = Client()
+app.fs_collection = Collection()
+"""
+
+def commits(lines):
+    return [line.split()[1] for line in lines if line.startswith("COMMIT ")]
+
+def test_buffered_writes_are_committed_at_exit(run_app):
+    # Exits with everything still buffered
+    lines = run_app(FAKE_FIRESTORE + """
+app.FS_BATCH_SIZE = 100
+app.FS_FLUSH_MS = 60_000
+ids = [app.save_result_to_firestore({"ok": True}, "m1", "test") for _ in range(3)]
+print("IDS", ",".join(ids), flush=True)
+""")
+    ids = next(line.split()[1] for line in lines if line.startswith("IDS "))
+    assert commits(lines) == [ids]
+
+def test_flush_timer_firing_during_shutdown_still_commits(run_app):
+    # doc1 is committing on the pool when the script exits, so the pool's
+    # shutdown waits on it; doc2's flush timer fires while it does
+    lines = run_app(FAKE_FIRESTORE + """
+COMMIT_DELAY = 1
+app.FS_BATCH_SIZE = 1
+app.save_result_to_firestore({"ok": True}, "m1", "test")
+app.FS_BATCH_SIZE = 100
+app.FS_FLUSH_MS = 300
+app.save_result_to_firestore({"ok": True}, "m2", "test")
+""")
+    assert sorted(commits(lines)) == ["doc1", "doc2"]
@@ -0,0 +1,60 @@
+import json
+
+# Uploads of different shapes, detected serially with the cache off, then
+# concurrently (so the batch worker sees mixed shapes) and once more from cache.
+SCRIPT = """
+import json
+import threading
+
+import cv2
+import numpy as np
+
+import app
+
+rng = np.random.default_rng(0)
+uploads = []
+for h, w in [(480, 640), (640, 480), (300, 900), (720, 720), (200, 640), (1000, 500)]:
+    img = rng.integers(0, 255, (h, w, 3), dtype=np.uint8)
+    cv2.rectangle(img, (w // 4, h // 4), (w // 2, h // 2), (30, 60, 200), -1)
+    uploads.append(bytearray(cv2.imencode(".jpg", img)[1].tobytes()))
+
+app.RESULT_CACHE_SIZE = 0
+serial = [app.detect_upload(b)[1] for b in uploads]
+
+app.RESULT_CACHE_SIZE = 64
+concurrent = [None] * (3 * len(uploads))
+def run(k):
+    concurrent[k] = app.detect_upload(uploads[k % len(uploads)])[1]
+threads = [threading.Thread(target=run, args=(k,)) for k in range(len(concurrent))]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+cached = [app.detect_upload(b)[1] for b in uploads]
+print("RESULTS", json.dumps({"serial": serial, "concurrent": concurrent, "cached": cached}), flush=True)
+"""
+
+def same_detections(a, b):
+    # Batch size alone moves confidences by float noise; the canvas must not
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if x is None or y is None:
+            if x is not y:
+                return False
+        elif (x["class_name"], x["component"]) != (y["class_name"], y["component"]):
+            return False
+        elif abs(x["confidence"] - y["confidence"]) > 1e-4:
+            return False
+    return True
+
+def test_detections_do_not_depend_on_concurrent_traffic(run_app):
+    lines = run_app(SCRIPT, CONF_THRESHOLD="0.001")
+    line = next(line for line in lines if line.startswith("RESULTS "))
+    results = json.loads(line[len("RESULTS "):])
+    serial = results["serial"]
+    n = len(serial)
+    assert any(det is not None for det in serial)
+    assert same_detections(results["concurrent"], [serial[k % n] for k in range(3 * n)])
+    assert same_detections(results["cached"], serial)